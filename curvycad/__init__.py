@@ -1,4 +1,5 @@
 # Import types to top-level namespace
 from .types import *
 from .builder import KicadTrackBuilder
+from .expand import ITEM_LINE, ITEM_ARC, ITEM_VIA
 from .dxf import read_dxf
\ No newline at end of file
@@ -1,5 +1,7 @@
+import functools
 import numpy as np
 from .types import *
+from .expand import ITEM_LINE, ITEM_ARC, ITEM_VIA, expand_parallel, expand_transverse, expand_vias
 
 def rotate(x, theta):
     x = np.asarray(x)
@@ -9,6 +11,10 @@ def rotate(x, theta):
     ])
     return np.dot(R, x.T).T
 
+def mm_to_nm(x):
+    """Round a distance in mm to integer nanometers"""
+    return int(round(x * 1e6))
+
 def warp_point_on_arc(p, radius):
     """Warp point (u, v) to cartesian x y
     u is distance along path
@@ -21,6 +27,23 @@ def warp_point_on_arc(p, radius):
     p = (0.0, radius + v)
     return rotate(p, theta) - (0.0, radius)
 
+def advance_along_path(x, y, theta, k, distance):
+    """Move a distance along a path element with curvature k (0 for a Straight),
+    starting at (x, y) in direction theta.
+
+    Returns the new (x, y, theta). Works elementwise on arrays.
+    """
+    k = np.asarray(k, dtype=np.float64)
+    straight = k == 0.0
+    safe_k = np.where(straight, 1.0, k)
+    angle = distance * k
+    # Displacement in the frame of the start point; see warp_point_on_arc
+    u = np.where(straight, distance, np.sin(angle) / safe_k)
+    v = np.where(straight, 0.0, (np.cos(angle) - 1.0) / safe_k)
+    cos_t = np.cos(theta)
+    sin_t = np.sin(theta)
+    return x + cos_t * u + sin_t * v, y - sin_t * u + cos_t * v, theta + angle
+
 class TrackBuilder(object):
     def __init__(self, pitch, pattern):
         """The TrackBuilder class contains all of the logic for transforming
@@ -36,9 +59,48 @@ class TrackBuilder(object):
         """
         self.pitch = pitch
         self.pattern = pattern
+        self.packed_pattern = self._packed_pattern(tuple(pattern))
         self.pos = np.array((0.0, 0.0))
         self.theta = 0.0
-        self.cycle_pos = 0.0
+
+    @classmethod
+    def pack_pattern(cls, pattern):
+        """Pack a list of PatternElements into one array per element type
+
+        Returns (parallel, parallel_layers, transverse, transverse_layers, vias),
+        where each of parallel, transverse and vias has one row per element of
+        that type, in pattern order, with the columns:
+            - parallel: start, end, offset, width
+            - transverse: offset, start, end, width
+            - vias: distance, transverse, drill, pad
+        """
+        parallel = [el for el in pattern if isinstance(el, ParallelLine)]
+        transverse = [el for el in pattern if isinstance(el, TransverseLine)]
+        vias = [el for el in pattern if isinstance(el, Via)]
+        for el in pattern:
+            if not isinstance(el, (ParallelLine, TransverseLine, Via)):
+                raise ValueError(f"Unsupported pattern element {el}")
+        return (
+            np.array([(el.start, el.end, el.offset, el.width) for el in parallel], dtype=np.float64).reshape(-1, 4),
+            np.array([el.layer for el in parallel], dtype=np.int64),
+            np.array([(el.offset, el.start, el.end, el.width) for el in transverse], dtype=np.float64).reshape(-1, 4),
+            np.array([el.layer for el in transverse], dtype=np.int64),
+            np.array([(el.distance, el.transverse, el.drill, el.pad) for el in vias], dtype=np.float64).reshape(-1, 4),
+        )
+
+    @classmethod
+    @functools.lru_cache(maxsize=16)
+    def _packed_pattern(cls, pattern):
+        """Memoized pack_pattern, so that every builder created for the same
+        pattern (e.g. on each run of a plugin) shares one set of packed arrays.
+
+        Elements are keyed by identity, so they must not be modified after a
+        builder has been created for them. The arrays are made read only.
+        """
+        packed = cls.pack_pattern(pattern)
+        for column in packed:
+            column.flags.writeable = False
+        return packed
 
     def set_location(self, p, theta):
         if len(p) != 2:
@@ -59,146 +121,125 @@ class TrackBuilder(object):
         cycles = np.round(total_length / self.pitch)
         pitch = total_length / cycles
 
+        frames = self.__slice_path(path, pitch, int(cycles))
+        self.emit_batch(*self.__expand(frames, pitch))
+
+    def __expand(self, frames, pitch):
+        """Project the pattern onto every slice produced by __slice_path
+
+        Returns the (kinds, x0, y0, xm, ym, x1, y1, widths, layers, drills)
+        arrays expected by emit_batch. Items are grouped by pattern element
+        type, and then ordered by slice.
+        """
+        parallel, parallel_layers, transverse, transverse_layers, vias = self.packed_pattern
+        n_slices = len(frames)
+        x, y, theta, k = frames[:, 0], frames[:, 1], frames[:, 2], frames[:, 3]
+        seg_start = frames[:, 4:5]
+        seg_end = frames[:, 5:6]
+
+        # Clip every element to every slice in one go. Lines are drawn where
+        # they overlap the slice; transverse lines and vias where they fall
+        # inside it. When a cycle is split between two path elements, a point
+        # right on the split belongs to the first slice only.
+        clipped_start = np.maximum(seg_start, parallel[:, 0])
+        clipped_end = np.minimum(seg_end, parallel[:, 1])
+        parallel_emit = clipped_start < clipped_end
+        parallel_u0 = (clipped_start - seg_start) * pitch
+        parallel_u1 = (clipped_end - seg_start) * pitch
+
+        def point_emit(along):
+            return ((along > seg_start) | (seg_start == 0.0)) & (along <= seg_end)
+        transverse_emit = point_emit(transverse[:, 0])
+        transverse_u = (transverse[:, 0] - seg_start) * pitch
+        via_emit = point_emit(vias[:, 0])
+        via_u = (vias[:, 0] - seg_start) * pitch
+
+        # Every element gets a row for every slice, in blocks by type
+        n_parallel = n_slices * len(parallel)
+        n_transverse = n_slices * len(transverse)
+        coords = np.empty((n_parallel + n_transverse + n_slices * len(vias), 6), dtype=np.float64)
+        expand_parallel(x, y, theta, k, parallel_emit, parallel_u0, parallel_u1, parallel[:, 2],
+                        coords[:n_parallel].reshape(n_slices, len(parallel), 6))
+        expand_transverse(x, y, theta, k, transverse_emit, transverse_u, transverse[:, 1], transverse[:, 2],
+                          coords[n_parallel:n_parallel + n_transverse].reshape(n_slices, len(transverse), 6))
+        expand_vias(x, y, theta, k, via_emit, via_u, vias[:, 1],
+                    coords[n_parallel + n_transverse:].reshape(n_slices, len(vias), 6))
+
+        # Only keep the rows which were emitted
+        keep = np.concatenate((parallel_emit.ravel(), transverse_emit.ravel(), via_emit.ravel()))
+        coords = coords[keep]
+        kinds = np.concatenate((
+            np.repeat(np.where(k == 0.0, ITEM_LINE, ITEM_ARC), len(parallel)),
+            np.full(n_transverse, ITEM_LINE),
+            np.full(n_slices * len(vias), ITEM_VIA),
+        ))[keep]
+        widths = np.concatenate((
+            np.tile(parallel[:, 3], n_slices), np.tile(transverse[:, 3], n_slices), np.tile(vias[:, 3], n_slices)
+        ))[keep]
+        layers = np.concatenate((
+            np.tile(parallel_layers, n_slices), np.tile(transverse_layers, n_slices), np.zeros(n_slices * len(vias), dtype=np.int64)
+        ))[keep]
+        drills = np.concatenate((
+            np.zeros(n_parallel + n_transverse), np.tile(vias[:, 2], n_slices)
+        ))[keep]
+        return (kinds, coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3], coords[:, 4], coords[:, 5],
+                widths, layers, drills)
+
+    def __slice_path(self, path, pitch, cycles):
+        """Break the path into slices, each of which covers (part of) one
+        pattern cycle on a single Straight or Curve
+
+        Returns an (n, 6) array of (x, y, theta, curvature, seg_start, seg_end)
+        rows, giving the board position and direction at the start of each
+        slice, the curvature of its path element (0 for a Straight), and the
+        part of the cycle (0 to 1) it covers.
+        """
+        # Starting position, direction, length and curvature of each drawn element
+        el_x, el_y, el_theta, el_length, el_k = [], [], [], [], []
         for el in path:
             if isinstance(el, Start):
-                self.pos = el.location
+                self.pos = np.array(el.location, dtype=np.float64)
                 self.theta = el.theta
+                continue
             elif isinstance(el, Straight):
-                self.__laydown_straight_distance(el.length, pitch)
+                k = 0.0
             elif isinstance(el, Curve):
-                self.__laydown_curve_distance(el.radius, el.angle, pitch)
-
-    def __laydown_straight_distance(self, distance, pitch):
-        distance_remaining = distance
-        while distance_remaining > 1e-12:
-            if self.cycle_pos > 0.0:
-                # Start mid cycle
-                seg_start = self.cycle_pos
-                if distance_remaining / pitch < 1.0 - seg_start - 1e-12:
-                    # End mid cycle too
-                    seg_end = distance_remaining / pitch + seg_start
-                    self.cycle_pos = seg_end + 1e-14
-                else:
-                    # Room to finish the cycle
-                    seg_end = 1.0
-                    self.cycle_pos = 0.0
+                k = np.sign(el.angle) / el.radius
             else:
-                seg_start = 0.0
-                if distance_remaining / pitch < 1.0 - 1e-12:
-                    # End mid cycle
-                    seg_end = distance_remaining / pitch
-                    self.cycle_pos = seg_end + 1e-14
-                else:
-                    # Room to finish the cycle
-                    seg_end = 1.0
-                    self.cycle_pos = 0.0
-
-            self.__laydown_straight_cycle(seg_start, seg_end, pitch)
-            distance_added = (seg_end - seg_start) * pitch
-            self.pos += rotate((distance_added, 0), self.theta)
-            distance_remaining -= distance_added
-
-
-    def __laydown_curve_distance(self, radius, angle, pitch):
-        distance_remaining = radius * np.abs(angle)
-        while distance_remaining > 1e-12:
-            if self.cycle_pos > 0.0:
-                # Start mid cycle
-                seg_start = self.cycle_pos
-                if distance_remaining / pitch < 1.0 - seg_start - 1e-12:
-                    # End mid cycle too
-                    seg_end = distance_remaining / pitch + seg_start
-                    self.cycle_pos = seg_end + 1e-14
-                else:
-                    # Room to finish the cycle
-                    seg_end = 1.0
-                    self.cycle_pos = 0.0
-            else:
-                seg_start = 0.0
-                if distance_remaining / pitch < 1.0 - 1e-12:
-                    # End mid cycle
-                    seg_end = distance_remaining / pitch
-                    self.cycle_pos = seg_end + 1e-14
-                else:
-                    # Room to finish the cycle
-                    seg_end = 1.0
-                    self.cycle_pos = 0.0
-
-            self.__laydown_curve_cycle(seg_start, seg_end, pitch, radius, angle)
-            distance_added = (seg_end - seg_start) * pitch
-            self.pos += rotate(warp_point_on_arc((distance_added, 0.0), radius * np.sign(angle)), self.theta)
-            self.theta += np.sign(angle) * distance_added / radius
-            distance_remaining -= distance_added
-
-    def __laydown_straight_cycle(self, seg_start, seg_end, pitch):
-        for el in self.pattern:
-            if isinstance(el, ParallelLine):
-                start = (
-                    (max(seg_start, el.start) - seg_start) * pitch,
-                    el.offset
-                )
-                end = (
-                    (min(seg_end, el.end) - seg_start) * pitch,
-                    el.offset
-                )
-                if start[0] > end[0]:
-                    continue
-                start = rotate(start, self.theta) + self.pos
-                end = rotate(end, self.theta) + self.pos
-                self.emit_line(start, end, el.width, el.layer)
-            elif isinstance(el, TransverseLine):
-                if el.offset >= seg_start and el.offset <= seg_end:
-                    start = ((el.offset - seg_start) * self.pitch, el.start)
-                    end = ((el.offset - seg_start) * self.pitch, el.end)
-                    start = rotate(start, self.theta) + self.pos
-                    end = rotate(end, self.theta) + self.pos
-                    self.emit_line(start, end, el.width, el.layer)
-            elif isinstance(el, Via):
-                if el.distance >= seg_start and el.distance <= seg_end:
-                    p = ((el.distance - seg_start) * self.pitch, el.transverse)
-                    p = rotate(p, self.theta) + self.pos
-                    self.emit_via(p, el.drill, el.pad)
-
-    def __laydown_curve_cycle(self, seg_start, seg_end, pitch, radius, angle):
-        for el in self.pattern:
-            if isinstance(el, ParallelLine):
-                start = (
-                    (max(seg_start, el.start) - seg_start) * pitch,
-                    el.offset
-                )
-                end = (
-                    (min(seg_end, el.end) - seg_start) * pitch,
-                    el.offset
-                )
-                if start[0] > end[0]:
-                    continue
-                # Curve the points onto the arc
-                start = warp_point_on_arc(start, radius * np.sign(angle))
-                end = warp_point_on_arc(end, radius * np.sign(angle))
-                mid = warp_point_on_arc(((start[0] + end[0])/2, el.offset), radius * np.sign(angle))
-
-                # Transform into current board coordinates
-                start = rotate(start, self.theta) + self.pos
-                end = rotate(end, self.theta) + self.pos
-                mid = rotate(mid, self.theta) + self.pos
-
-                self.emit_arc(start, mid, end, el.width, el.layer)
-            elif isinstance(el, TransverseLine):
-                if el.offset >= seg_start and el.offset <= seg_end:
-                    # Line in local coordinates on arc
-                    p0 = warp_point_on_arc(((el.offset - seg_start) * self.pitch, el.start), radius * np.sign(angle))
-                    p1 = warp_point_on_arc(((el.offset - seg_start) * self.pitch, el.end), radius * np.sign(angle))
-
-                    # Transform into board coordinates
-                    p0 = rotate(p0, self.theta) + self.pos
-                    p1 = rotate(p1, self.theta) + self.pos
-
-                    self.emit_line(p0, p1, el.width, el.layer)
-            elif isinstance(el, Via):
-                if el.distance >= seg_start and el.distance <= seg_end:
-                    p = warp_point_on_arc(((el.distance - seg_start) * self.pitch, el.transverse), radius * np.sign(angle))
-                    p = rotate(p, self.theta) + self.pos
-                    self.emit_via(p, el.drill, el.pad)
+                continue
+            if el.length <= 1e-12:
+                continue
+            el_x.append(self.pos[0])
+            el_y.append(self.pos[1])
+            el_theta.append(self.theta)
+            el_length.append(el.length)
+            el_k.append(k)
+            x, y, self.theta = advance_along_path(self.pos[0], self.pos[1], self.theta, k, el.length)
+            self.pos = np.array((x, y))
+        el_x, el_y, el_theta, el_k = map(np.array, (el_x, el_y, el_theta, el_k))
+
+        # All positions along the path are measured in cycles from here on, so
+        # that cycle boundaries are the exact integers. Element boundaries which
+        # (almost) coincide with a cycle boundary are snapped to it.
+        el_edges = np.concatenate(([0.0], np.cumsum(el_length))) / pitch
+        nearest = np.round(el_edges)
+        el_edges = np.where(np.abs(el_edges - nearest) < 1e-9, nearest, el_edges)
+        edges = np.union1d(np.arange(cycles + 1, dtype=np.float64), el_edges)
+        t0 = edges[:-1]
+        t1 = edges[1:]
+        keep = (t1 - t0) * pitch > 1e-12
+        t0 = t0[keep]
+        t1 = t1[keep]
+
+        # Find the element and the cycle each slice falls in
+        mid = 0.5 * (t0 + t1)
+        el_index = np.clip(np.searchsorted(el_edges, mid, side='right') - 1, 0, len(el_k) - 1)
+        cycle = np.floor(mid)
+        distance = (t0 - el_edges[el_index]) * pitch
+
+        k = el_k[el_index]
+        x, y, theta = advance_along_path(el_x[el_index], el_y[el_index], el_theta[el_index], k, distance)
+        return np.column_stack((x, y, theta, k, t0 - cycle, t1 - cycle))
 
     def draw_straight(self, cycles, pitch):
         n_cycles = int(cycles)
@@ -270,14 +311,32 @@ class TrackBuilder(object):
             self.pos += rotate(warp_point_on_arc((self.pitch, 0.0), radius * np.sign(angle)), self.theta)
             self.theta += angle / n_cycles
 
-        def emit_line(self, p0, p1, width, layer):
-            raise RuntimeError("TrackBuilder is abstract. Use KicadTrackBuilder, or implement your own emit methods.")
+    def emit_batch(self, kinds, x0, y0, xm, ym, x1, y1, widths, layers, drills):
+        """Emit the items produced by projecting the pattern onto a path
+
+        All arguments are equal length arrays, one entry per item. Widths and
+        drills are passed through as packed by `pack_pattern`. The default
+        implementation calls `emit_line`, `emit_arc`, or `emit_via` for each
+        item; builders which can create items in bulk may override it.
+        """
+        x0, y0, xm, ym, x1, y1 = x0.tolist(), y0.tolist(), xm.tolist(), ym.tolist(), x1.tolist(), y1.tolist()
+        widths, layers, drills = widths.tolist(), layers.tolist(), drills.tolist()
+        for i, kind in enumerate(kinds.tolist()):
+            if kind == ITEM_LINE:
+                self.emit_line((x0[i], y0[i]), (x1[i], y1[i]), widths[i], layers[i])
+            elif kind == ITEM_ARC:
+                self.emit_arc((x0[i], y0[i]), (xm[i], ym[i]), (x1[i], y1[i]), widths[i], layers[i])
+            else:
+                self.emit_via((x0[i], y0[i]), drills[i], widths[i])
+
+    def emit_line(self, p0, p1, width, layer):
+        raise RuntimeError("TrackBuilder is abstract. Use KicadTrackBuilder, or implement your own emit methods.")
 
-        def emit_arc(self, start, mid, end, width, layer):
-            raise RuntimeError("TrackBuilder is abstract. Use KicadTrackBuilder, or implement your own emit methods.")
+    def emit_arc(self, start, mid, end, width, layer):
+        raise RuntimeError("TrackBuilder is abstract. Use KicadTrackBuilder, or implement your own emit methods.")
 
-        def emit_via(self, p, drill, pad):
-            raise RuntimeError("TrackBuilder is abstract. Use KicadTrackBuilder, or implement your own emit methods.")
+    def emit_via(self, p, drill, pad):
+        raise RuntimeError("TrackBuilder is abstract. Use KicadTrackBuilder, or implement your own emit methods.")
 
 class KicadTrackBuilder(TrackBuilder):
     def __init__(self, pitch, pattern, board):
@@ -300,7 +359,7 @@ class KicadTrackBuilder(TrackBuilder):
             track = pcbnew.PCB_SHAPE(self.board, pcbnew.PCB_SHAPE_T, pcbnew.SHAPE_T_SEGMENT)
         track.SetStart(self.__pcbpoint(p0))
         track.SetEnd(self.__pcbpoint(p1))
-        track.SetWidth(int(width * 1e6))
+        track.SetWidth(mm_to_nm(width))
         track.SetLayer(layer)
         self.board.Add(track)
         self.group.AddItem(track)
@@ -315,7 +374,7 @@ class KicadTrackBuilder(TrackBuilder):
             track = pcbnew.PCB_SHAPE(self.board, pcbnew.PCB_SHAPE_T, pcbnew.SHAPE_T_ARC)
             track.SetArcGeometry(self.__pcbpoint(start), self.__pcbpoint(mid), self.__pcbpoint(end))
 
-        track.SetWidth(int(width * 1e6))
+        track.SetWidth(mm_to_nm(width))
         track.SetLayer(layer)
         self.board.Add(track)
         self.group.AddItem(track)
@@ -323,8 +382,8 @@ class KicadTrackBuilder(TrackBuilder):
     def emit_via(self, p, drill, pad):
         via = pcbnew.PCB_VIA(self.board)
         via.SetPosition(self.__pcbpoint(p))
-        via.SetDrill(int(drill * 1e6))
-        via.SetWidth(int(pad * 1e6))
+        via.SetDrill(mm_to_nm(drill))
+        via.SetWidth(mm_to_nm(pad))
         self.board.Add(via)
         self.group.AddItem(via)
 
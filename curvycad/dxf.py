@@ -4,6 +4,8 @@ import ezdxf
 from ezdxf.entities import Arc, Line, LWPolyline
 import math
 import numpy as np
+import os
+import tempfile
 from typing import AnyStr, List, Tuple, Union
 
 from .types import PathElement, Curve, Straight, Start
@@ -235,12 +237,53 @@ def __read_dxf_elements(filepath: AnyStr):
 
     return ordered_elements
 
-def read_dxf(filename) -> List[PathElement]:
+# Kinds of path element, as stored in a read_dxf cache file
+_CACHE_START = 0
+_CACHE_STRAIGHT = 1
+_CACHE_CURVE = 2
+
+def path_to_array(path: List[PathElement]) -> np.ndarray:
+    """Encode a path as an (n, 4) array of (kind, a, b, c) rows
+
+    Start is (x, y, theta), Straight is (length, 0, 0), and Curve is
+    (angle, radius, 0).
+    """
+    rows = []
+    for el in path:
+        if isinstance(el, Start):
+            rows.append((_CACHE_START, el.location[0], el.location[1], el.theta))
+        elif isinstance(el, Straight):
+            rows.append((_CACHE_STRAIGHT, el.length, 0.0, 0.0))
+        elif isinstance(el, Curve):
+            rows.append((_CACHE_CURVE, el.angle, el.radius, 0.0))
+        else:
+            raise ValueError(f"Unknown element {el}")
+    return np.array(rows, dtype=np.float64).reshape(-1, 4)
+
+def array_to_path(rows: np.ndarray) -> List[PathElement]:
+    """Decode a path encoded by `path_to_array`"""
+    path = []
+    for kind, a, b, c in rows.tolist():
+        if kind == _CACHE_START:
+            path.append(Start((a, b), c))
+        elif kind == _CACHE_STRAIGHT:
+            path.append(Straight(a))
+        elif kind == _CACHE_CURVE:
+            path.append(Curve(a, b))
+        else:
+            raise ValueError(f"Unknown path element kind {kind}")
+    return path
+
+def read_dxf(filename, cache=False) -> List[PathElement]:
     """Reads a DXF file, and returns it as a list of PathElements.
 
     The first element is a Start, giving the starting position of the curve.
     This is followed by a collection of Straight and Curve elements.
 
+    If cache is True, the path is also saved next to the DXF, in
+    `<filename>.cache.npz`, and later calls load it from there for as long as
+    the DXF's modification time and size are unchanged.
+
     There are some requirements on the DXF:
         - It can only have Arcs and Lines
         - They must all be connected (i.e. Each endpoint -- except perhaps
@@ -251,6 +294,9 @@ def read_dxf(filename) -> List[PathElement]:
           consecutive.)
     """
 
+    if cache:
+        return __read_dxf_cached(filename)
+
     # Get elements, re-ordered/reversed as necessary
     elements = __read_dxf_elements(filename)
 
@@ -279,4 +325,34 @@ def read_dxf(filename) -> List[PathElement]:
             path += reduce_lw_polyline(el)
         else:
             raise ValueError(f"Unknown element {el}")
-    return path
\ No newline at end of file
+    return path
+
+def __read_dxf_cached(filename) -> List[PathElement]:
+    stat = os.stat(filename)
+    key = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    cache_path = f"{filename}.cache.npz"
+    try:
+        with open(cache_path, 'rb') as f, np.load(f) as cached:
+            if np.array_equal(cached['meta'], key):
+                return array_to_path(cached['path'])
+    except Exception:
+        # Missing, truncated, corrupt, or from an incompatible version; the
+        # cache is only an optimization, so just parse the DXF again
+        pass
+
+    path = read_dxf(filename)
+    # Write to a temporary file and move it into place, so that an
+    # interrupted write never leaves a partial cache file behind
+    try:
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(cache_path) or '.')
+    except OSError:
+        # e.g. a read only project directory; caching is only an optimization
+        return path
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, meta=key, path=path_to_array(path))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # e.g. a full disk
+        os.remove(tmp_path)
+    return path
@@ -0,0 +1,120 @@
+"""Projection of a packed pattern onto the slices of a path
+
+A pattern is packed once into one array per kind of PatternElement (see
+`TrackBuilder.pack_pattern`), and the path is broken into slices, each of
+which covers some part of one pattern cycle on a single Straight or Curve.
+The `expand_*` kernels then compute the board coordinates of every element of
+one kind in every slice, in one compiled loop without any branching on type.
+
+numba is optional. Without it the kernels run as plain python, which is still
+somewhat faster than the original per-element numpy arithmetic.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+    prange = range
+
+# Kinds of emitted items
+ITEM_LINE = 0
+ITEM_ARC = 1
+ITEM_VIA = 2
+
+
+@njit(cache=True)
+def _warp(u, v, k, r):
+    """Local path coordinates (u along, v across) to the slice frame
+
+    k is the signed curvature of the slice (0 for a straight), and r = 1/k.
+    This is the same mapping as `builder.warp_point_on_arc`.
+    """
+    if k == 0.0:
+        return u, v
+    a = u * k
+    return (r + v) * np.sin(a), (r + v) * np.cos(a) - r
+
+
+@njit(cache=True)
+def _to_board(lx, ly, cos_t, sin_t, px, py):
+    """Slice frame coordinates to board coordinates; see `builder.rotate`"""
+    return cos_t * lx + sin_t * ly + px, -sin_t * lx + cos_t * ly + py
+
+
+# Each of the kernels below projects one kind of pattern element onto every
+# slice of the path. Slice c starts at board position (frame_x[c], frame_y[c])
+# heading in direction frame_theta[c], with curvature frame_k[c]. Element i is
+# drawn in slice c only if emit[c, i] is set, at u[c, i] (or from u0[c, i] to
+# u1[c, i]) along the path, measured from the start of the slice.
+#
+# The results are written to out[c, i] as (x0, y0, xm, ym, x1, y1) board
+# coordinates. Entries which are not emitted are left untouched. Slices are
+# independent, and each only writes its own out[c], so they are spread across
+# threads.
+
+@njit(parallel=True, fastmath=True, cache=True)
+def expand_parallel(frame_x, frame_y, frame_theta, frame_k, emit, u0, u1, offsets, out):
+    """Project parallel lines, which become lines on a Straight and arcs on a Curve"""
+    for c in prange(len(frame_x)):
+        k = frame_k[c]
+        r = 1.0 / k if k != 0.0 else 0.0
+        cos_t = np.cos(frame_theta[c])
+        sin_t = np.sin(frame_theta[c])
+        px = frame_x[c]
+        py = frame_y[c]
+        for i in range(len(offsets)):
+            if not emit[c, i]:
+                continue
+            lx, ly = _warp(u0[c, i], offsets[i], k, r)
+            out[c, i, 0], out[c, i, 1] = _to_board(lx, ly, cos_t, sin_t, px, py)
+            lx, ly = _warp(0.5 * (u0[c, i] + u1[c, i]), offsets[i], k, r)
+            out[c, i, 2], out[c, i, 3] = _to_board(lx, ly, cos_t, sin_t, px, py)
+            lx, ly = _warp(u1[c, i], offsets[i], k, r)
+            out[c, i, 4], out[c, i, 5] = _to_board(lx, ly, cos_t, sin_t, px, py)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def expand_transverse(frame_x, frame_y, frame_theta, frame_k, emit, u, starts, ends, out):
+    """Project transverse lines, from starts[i] to ends[i] across the path"""
+    for c in prange(len(frame_x)):
+        k = frame_k[c]
+        r = 1.0 / k if k != 0.0 else 0.0
+        cos_t = np.cos(frame_theta[c])
+        sin_t = np.sin(frame_theta[c])
+        px = frame_x[c]
+        py = frame_y[c]
+        for i in range(len(starts)):
+            if not emit[c, i]:
+                continue
+            lx, ly = _warp(u[c, i], starts[i], k, r)
+            x0, y0 = _to_board(lx, ly, cos_t, sin_t, px, py)
+            lx, ly = _warp(u[c, i], ends[i], k, r)
+            x1, y1 = _to_board(lx, ly, cos_t, sin_t, px, py)
+            out[c, i, 0], out[c, i, 1] = x0, y0
+            out[c, i, 2], out[c, i, 3] = x0, y0
+            out[c, i, 4], out[c, i, 5] = x1, y1
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def expand_vias(frame_x, frame_y, frame_theta, frame_k, emit, u, transverses, out):
+    """Project vias; all three points of the output are the via position"""
+    for c in prange(len(frame_x)):
+        k = frame_k[c]
+        r = 1.0 / k if k != 0.0 else 0.0
+        cos_t = np.cos(frame_theta[c])
+        sin_t = np.sin(frame_theta[c])
+        px = frame_x[c]
+        py = frame_y[c]
+        for i in range(len(transverses)):
+            if not emit[c, i]:
+                continue
+            lx, ly = _warp(u[c, i], transverses[i], k, r)
+            x, y = _to_board(lx, ly, cos_t, sin_t, px, py)
+            out[c, i, 0], out[c, i, 1] = x, y
+            out[c, i, 2], out[c, i, 3] = x, y
+            out[c, i, 4], out[c, i, 5] = x, y
@@ -1,6 +1,7 @@
 """KiCad plugin to generate linear stepper track traces in KiCad"""
 
 
+import numpy as np
 import pcbnew
 import curvycad as cc
 import os
@@ -112,95 +113,248 @@ segment = [
     ),
 ]
 
+class StagingColumns(object):
+    """Preallocated float64 columns, plus kind and layer columns, written by row index"""
+    def __init__(self, n_columns):
+        self.values = np.empty((0, n_columns), dtype=np.float64)
+        self.kinds = np.empty(0, dtype=np.int8)
+        self.layers = np.empty(0, dtype=np.int32)
+        self.n = 0
+
+    def reserve(self, count):
+        """Make sure there is room for `count` more rows"""
+        needed = self.n + count
+        if needed <= len(self.values):
+            return
+        capacity = max(needed, 2 * len(self.values))
+        values = np.empty((capacity, self.values.shape[1]), dtype=np.float64)
+        kinds = np.empty(capacity, dtype=np.int8)
+        layers = np.empty(capacity, dtype=np.int32)
+        values[:self.n] = self.values[:self.n]
+        kinds[:self.n] = self.kinds[:self.n]
+        layers[:self.n] = self.layers[:self.n]
+        self.values = values
+        self.kinds = kinds
+        self.layers = layers
+
+    def append(self, kind, row, layer=0):
+        self.reserve(1)
+        self.values[self.n] = row
+        self.kinds[self.n] = kind
+        self.layers[self.n] = layer
+        self.n += 1
+
+    def extend(self, kinds, columns, layers):
+        count = len(kinds)
+        self.reserve(count)
+        rows = slice(self.n, self.n + count)
+        for j, column in enumerate(columns):
+            self.values[rows, j] = column
+        self.kinds[rows] = kinds
+        self.layers[rows] = layers
+        self.n += count
+
+    def clear(self):
+        self.n = 0
+
 # Custom version of KicadTrackBuilder with fixes for KiCad 9.0
+#
+# Rather than creating board items one at a time as the pattern is laid out,
+# the emit methods only record the geometry into preallocated columns. The
+# board items are created by `flush()`, which converts all of the coordinates
+# to nanometers in one numpy pass, and then creates every item in one loop.
 class FixedKicadTrackBuilder(cc.KicadTrackBuilder):
-    def point_to_vector2i(self, p):
-        """Convert a coordinate to a VECTOR2I object"""
-        return pcbnew.VECTOR2I(int(p[0] * 1e6), int(p[1] * 1e6))
-    
+    def __init__(self, pitch, pattern, board):
+        super().__init__(pitch, pattern, board)
+        # VECTOR2I pad and drill sizes, keyed by size (nm). These are the same
+        # for every via in a pattern, and KiCad copies them when they are set.
+        self._size_cache = {}
+        # Items created by flush(), waiting to be added to the board by commit()
+        self._pending_items = []
+        # Where pcbnew supports it, add items in bulk mode and update the
+        # connectivity once at the end, rather than after every item. Bulk
+        # adds skip the per item notifications to board listeners, so they
+        # are only used if FinalizeBulkAdd, which sends one notification for
+        # all of them, can be called with a python list of items.
+        self._bulk_add_mode = getattr(pcbnew, 'ADD_MODE_BULK_APPEND', None)
+        if self._bulk_add_mode is not None:
+            try:
+                self.board.FinalizeBulkAdd([])
+            except Exception:
+                self._bulk_add_mode = None
+
+        # Staged items, with columns x0, y0, xm, ym, x1, y1 (mm) and width,
+        # drill (integer nm). Lines leave the mid point unused, and vias use
+        # (x0, y0) as their position and width as their pad size.
+        self._staged = StagingColumns(8)
+        # Lookup table of which layer ids are routing (copper) layers
+        self._is_routing = np.zeros(pcbnew.PCB_LAYER_ID_COUNT, dtype=bool)
+        self._is_routing[self.routing_layers] = True
+
+        # Create proper PCB_VIAs if this version of pcbnew supports them, and
+        # fall back to single pad footprints if not. This is decided once
+        # here, with a throwaway via, rather than for every via in flush().
+        try:
+            self._make_via_pcb_via(pcbnew.VECTOR2I(0, 0), 0, 0)
+            self._make_via = self._make_via_pcb_via
+        except Exception as e:
+            print(f"Warning: Could not create via using PCB_VIA, using footprints instead. Error: {e}")
+            self._make_via = self._make_via_footprint
+
+    def draw_path(self, path):
+        # Reserve enough room for every element in every slice. There is at
+        # most one slice per cycle, plus one for each path element that
+        # leaves a cycle unfinished.
+        n_slices = int(np.ceil(sum(el.length for el in path) / self.pitch)) + len(path)
+        self._staged.reserve(n_slices * len(self.pattern))
+
+        super().draw_path(path)
+        self.flush()
+        self.commit()
+
+    @classmethod
+    def pack_pattern(cls, pattern):
+        """Pack the pattern with widths, drills and pads already rounded to
+        integer nanometers, so that they only need rounding once per pattern
+        rather than once per emitted item.
+        """
+        parallel, parallel_layers, transverse, transverse_layers, vias = super().pack_pattern(pattern)
+        parallel[:, 3] = np.rint(parallel[:, 3] * 1e6)
+        transverse[:, 3] = np.rint(transverse[:, 3] * 1e6)
+        vias[:, 2:] = np.rint(vias[:, 2:] * 1e6)
+        return parallel, parallel_layers, transverse, transverse_layers, vias
+
+    def emit_batch(self, kinds, x0, y0, xm, ym, x1, y1, widths, layers, drills):
+        self._staged.extend(kinds, (x0, y0, xm, ym, x1, y1, widths, drills), layers)
+
     def emit_line(self, p0, p1, width, layer):
-        """Fixed version of emit_line for KiCad 9.0 compatibility"""
-        if layer in self.routing_layers:
-            track = pcbnew.PCB_TRACK(self.board)
-        else:
-            track = pcbnew.PCB_SHAPE(self.board)
-            track.SetShape(pcbnew.SHAPE_T_SEGMENT)
-            
-        # Convert to VECTOR2I for start and end points
-        start_point = self.point_to_vector2i(p0)
-        end_point = self.point_to_vector2i(p1)
-        
-        track.SetStart(start_point)
-        track.SetEnd(end_point)
-        track.SetWidth(int(width * 1e6))
-        track.SetLayer(layer)
-        self.board.Add(track)
-        self.group.AddItem(track)
+        self._staged.append(cc.ITEM_LINE, (p0[0], p0[1], p0[0], p0[1], p1[0], p1[1], round(width * 1e6), 0), layer)
 
     def emit_arc(self, start, mid, end, width, layer):
-        """Fixed version of emit_arc for KiCad 9.0 compatibility"""
-        # Convert points to VECTOR2I
-        start_point = self.point_to_vector2i(start)
-        mid_point = self.point_to_vector2i(mid)
-        end_point = self.point_to_vector2i(end)
-        
-        if layer in self.routing_layers:
-            # For routing layers, use PCB_ARC
-            track = pcbnew.PCB_ARC(self.board)
-            track.SetStart(start_point)
-            track.SetMid(mid_point)
-            track.SetEnd(end_point)
-        else:
-            # For other layers, use PCB_SHAPE as an arc
-            track = pcbnew.PCB_SHAPE(self.board)
-            track.SetShape(pcbnew.SHAPE_T_ARC)
-            
-            # For KiCad 9.0, we need to use SetArcGeometry with correct parameter types
-            track.SetArcGeometry(start_point, mid_point, end_point)
+        self._staged.append(cc.ITEM_ARC, (start[0], start[1], mid[0], mid[1], end[0], end[1], round(width * 1e6), 0), layer)
 
-        track.SetWidth(int(width * 1e6))
-        track.SetLayer(layer)
-        self.board.Add(track)
-        self.group.AddItem(track)
-    
     def emit_via(self, p, drill, pad):
-        """Fixed version of emit_via for KiCad 9.0 compatibility"""
-        # Try first to create a proper PCB_VIA
-        try:
-            via = pcbnew.PCB_VIA(self.board)
-            position = self.point_to_vector2i(p)
-            via.SetPosition(position)
-            via.SetViaType(pcbnew.VIATYPE_THROUGH)
-            via.SetLayerPair(pcbnew.F_Cu, pcbnew.B_Cu)
-            via.SetDrill(int(drill * 1e6))
-            via.SetWidth(int(pad * 1e6))  # Set via diameter
-            self.board.Add(via)
-            self.group.AddItem(via)
-            return
-        except Exception as e:
-            print(f"Warning: Could not create via using PCB_VIA at {p}. Error: {e}")
-        
-        # Fall back to footprint approach if PCB_VIA fails
-        try:
-            module = pcbnew.FOOTPRINT(self.board)
-            position = self.point_to_vector2i(p)
-            module.SetPosition(position)
-            module.SetReference("")
-            module.SetValue("")
-            
-            pad_item = pcbnew.PAD(module)
-            pad_item.SetShape(pcbnew.PAD_SHAPE_CIRCLE)
-            pad_item.SetAttribute(pcbnew.PAD_ATTRIB_PTH)
-            pad_item.SetSize(pcbnew.VECTOR2I(int(pad * 1e6), int(pad * 1e6)))
-            pad_item.SetPosition(position)
-            pad_item.SetDrillSize(pcbnew.VECTOR2I(int(drill * 1e6), int(drill * 1e6)))
-            pad_item.SetNumber("")
-            
-            module.Add(pad_item)
-            self.board.Add(module)
-            self.group.AddItem(module)
-        except Exception as e2:
-            print(f"Error creating via using footprint fallback: {e2}")
+        self._staged.append(cc.ITEM_VIA, (p[0], p[1], p[0], p[1], p[0], p[1], round(pad * 1e6), round(drill * 1e6)))
+
+    def _size(self, size):
+        vector = self._size_cache.get(size)
+        if vector is None:
+            vector = self._size_cache[size] = pcbnew.VECTOR2I(size, size)
+        return vector
+
+    def commit(self):
+        """Add all of the items created by flush() to the board and the group"""
+        items = self._pending_items
+        self._pending_items = []
+        add = self.board.Add
+        if self._bulk_add_mode is not None:
+            mode = self._bulk_add_mode
+            for item in items:
+                add(item, mode, True)
+            self.board.BuildConnectivity()
+            self.board.FinalizeBulkAdd(items)
+        else:
+            for item in items:
+                add(item)
+        add_to_group = self.group.AddItem
+        for item in items:
+            add_to_group(item)
+
+    def flush(self):
+        """Create board items for everything emitted since the last flush
+
+        This is the fixed version of emit_line/emit_arc/emit_via for KiCad 9.0
+        compatibility. The items are not added to the board until commit() is
+        called.
+        """
+        n = self._staged.n
+        # Create (and so add) the items grouped by layer, and then by kind
+        order = np.lexsort((self._staged.kinds[:n], self._staged.layers[:n]))
+        values = self._staged.values[order]
+        rows = np.column_stack((np.rint(values[:, :6] * 1e6), values[:, 6:])).astype(np.int64).tolist()
+        kinds = self._staged.kinds[order].tolist()
+        layers = self._staged.layers[order]
+        routing = self._is_routing[layers].tolist()
+        layers = layers.tolist()
+        self._staged.clear()
+
+        # Look everything used in the loop up once, rather than once per item
+        VECTOR2I = pcbnew.VECTOR2I
+        PCB_TRACK = pcbnew.PCB_TRACK
+        PCB_ARC = pcbnew.PCB_ARC
+        PCB_SHAPE = pcbnew.PCB_SHAPE
+        SHAPE_T_SEGMENT = pcbnew.SHAPE_T_SEGMENT
+        SHAPE_T_ARC = pcbnew.SHAPE_T_ARC
+        ITEM_LINE = cc.ITEM_LINE
+        ITEM_VIA = cc.ITEM_VIA
+        board = self.board
+        make_via = self._make_via
+        add_pending = self._pending_items.append
+
+        # Creating the items is what remains of the cost: a handful of SWIG
+        # calls per item. They can't be built natively instead, as KiCad does
+        # not provide headers or a stable C++ ABI to build extensions against,
+        # and the objects have to be owned by pcbnew's own SWIG wrappers.
+        for kind, layer, is_routing, (x0, y0, xm, ym, x1, y1, width, drill) in zip(kinds, layers, routing, rows):
+            if kind == ITEM_VIA:
+                add_pending(make_via(VECTOR2I(x0, y0), drill, width))
+                continue
+
+            start_point = VECTOR2I(x0, y0)
+            end_point = VECTOR2I(x1, y1)
+            if kind == ITEM_LINE:
+                if is_routing:
+                    track = PCB_TRACK(board)
+                else:
+                    track = PCB_SHAPE(board)
+                    track.SetShape(SHAPE_T_SEGMENT)
+                track.SetStart(start_point)
+                track.SetEnd(end_point)
+            else:
+                mid_point = VECTOR2I(xm, ym)
+                if is_routing:
+                    # For routing layers, use PCB_ARC
+                    track = PCB_ARC(board)
+                    track.SetStart(start_point)
+                    track.SetMid(mid_point)
+                    track.SetEnd(end_point)
+                else:
+                    # For other layers, use PCB_SHAPE as an arc
+                    track = PCB_SHAPE(board)
+                    track.SetShape(SHAPE_T_ARC)
+
+                    # For KiCad 9.0, we need to use SetArcGeometry with correct parameter types
+                    track.SetArcGeometry(start_point, mid_point, end_point)
+
+            track.SetWidth(width)
+            track.SetLayer(layer)
+            add_pending(track)
+
+    def _make_via_pcb_via(self, position, drill, pad):
+        via = pcbnew.PCB_VIA(self.board)
+        via.SetPosition(position)
+        via.SetViaType(pcbnew.VIATYPE_THROUGH)
+        via.SetLayerPair(pcbnew.F_Cu, pcbnew.B_Cu)
+        via.SetDrill(drill)
+        via.SetWidth(pad)  # Set via diameter
+        return via
+
+    def _make_via_footprint(self, position, drill, pad):
+        module = pcbnew.FOOTPRINT(self.board)
+        module.SetPosition(position)
+        module.SetReference("")
+        module.SetValue("")
+
+        pad_item = pcbnew.PAD(module)
+        pad_item.SetShape(pcbnew.PAD_SHAPE_CIRCLE)
+        pad_item.SetAttribute(pcbnew.PAD_ATTRIB_PTH)
+        pad_item.SetSize(self._size(pad))
+        pad_item.SetPosition(position)
+        pad_item.SetDrillSize(self._size(drill))
+        pad_item.SetNumber("")
+
+        module.Add(pad_item)
+        return module
 
 class TrackLayout(pcbnew.ActionPlugin):
     def defaults(self):
@@ -242,9 +396,12 @@ class TrackLayout(pcbnew.ActionPlugin):
                     dxf_file = fileDialog.GetPath()
             
             try:
-                guide = cc.read_dxf(dxf_file)
-                for el in guide:
-                    print(el)
+                guide = cc.read_dxf(dxf_file, cache=True)
+                # Printing every path element to the scripting console is slow
+                # for large DXFs, so it is only done when asked for
+                if os.environ.get('CURVYCAD_DEBUG'):
+                    for el in guide:
+                        print(el)
                 
                 # Use the fixed track builder for KiCad 9.0 compatibility
                 track = FixedKicadTrackBuilder(PITCH, segment, board)
@@ -9,5 +9,8 @@ setup(
     install_requires=[
         'numpy',
         'ezdxf',
-    ]
+    ],
+    extras_require={
+        'jit': ['numba'],
+    }
 )
\ No newline at end of file
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import ezdxf
+import numpy as np
+
+import curvycad as cc
+
+
+class TestReadDxfCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'path.dxf')
+        self.cache_path = f"{self.filename}.cache.npz"
+        doc = ezdxf.new()
+        # A straight, then a tangent quarter circle of radius 5
+        bulge = np.tan(np.pi / 8)
+        doc.modelspace().add_lwpolyline([(0, 0, 0, 0, 0), (10, 0, 0, 0, bulge), (15, 5, 0, 0, 0)])
+        doc.saveas(self.filename)
+        self.expected = cc.read_dxf(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertPathsEqual(self, a, b):
+        np.testing.assert_allclose(cc.dxf.path_to_array(a), cc.dxf.path_to_array(b))
+
+    def test_cache_is_written_and_reused(self):
+        self.assertPathsEqual(cc.read_dxf(self.filename, cache=True), self.expected)
+        self.assertTrue(os.path.exists(self.cache_path))
+        self.assertPathsEqual(cc.read_dxf(self.filename, cache=True), self.expected)
+
+    def test_corrupt_cache_is_replaced(self):
+        cc.read_dxf(self.filename, cache=True)
+        with open(self.cache_path, 'rb') as f:
+            valid = f.read()
+        for corrupt in (b'', valid[:len(valid) // 2], b'not a zip file'):
+            with self.subTest(size=len(corrupt)):
+                with open(self.cache_path, 'wb') as f:
+                    f.write(corrupt)
+                self.assertPathsEqual(cc.read_dxf(self.filename, cache=True), self.expected)
+                with np.load(self.cache_path) as cached:
+                    self.assertIn('path', cached)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['path.dxf', 'path.dxf.cache.npz'])
+
+
+if __name__ == '__main__':
+    unittest.main()